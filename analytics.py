@@ -0,0 +1,98 @@
+"""Aggregation kernels for the analytics dashboard"""
+from typing import Dict, Sequence, Tuple
+import numpy as np
+
+from config import Config
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Fallback when numba is not installed: run the kernel as plain Python"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+NO_EMOTION = -1  # emotion_idx sentinel for messages without an emotion
+
+def encode_analysis(analysis: Dict[str, any]) -> Dict[str, int]:
+    """Columnar per-message aggregates stored alongside the message at insert time"""
+    emotion = analysis.get('emotion')
+    sentiments = list(analysis.get('aspect_sentiment', {}).values())
+    return {
+        'emotion_idx': Config.EMOTION_LABELS.index(emotion) if emotion in Config.EMOTION_LABELS else NO_EMOTION,
+        'sentiment_positive': sentiments.count('positive'),
+        'sentiment_negative': sentiments.count('negative'),
+        'sentiment_neutral': sentiments.count('neutral')
+    }
+
+@njit(cache=True)
+def aggregate(emotion_idx: np.ndarray, sentiment_counts: np.ndarray, n_emotions: int):
+    """Sum emotion occurrences and aspect sentiment counts over a window of messages"""
+    emotion_totals = np.zeros(n_emotions, dtype=np.int64)
+    sentiment_totals = np.zeros(sentiment_counts.shape[1], dtype=np.int64)
+    
+    for i in range(emotion_idx.shape[0]):
+        idx = emotion_idx[i]
+        if idx >= 0:
+            emotion_totals[idx] += 1
+        for j in range(sentiment_counts.shape[1]):
+            sentiment_totals[j] += sentiment_counts[i, j]
+    
+    return emotion_totals, sentiment_totals
+
+def summarize(rows: Sequence[Tuple]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Emotion and sentiment distributions from (emotion_idx, positive, negative, neutral) rows"""
+    data = np.array(
+        [[NO_EMOTION if idx is None else idx, pos or 0, neg or 0, neu or 0]
+         for idx, pos, neg, neu in rows],
+        dtype=np.int16
+    ).reshape(-1, 4)
+    
+    emotion_totals, sentiment_totals = aggregate(
+        data[:, 0], np.ascontiguousarray(data[:, 1:]), len(Config.EMOTION_LABELS)
+    )
+    
+    emotion_counts = {
+        label: int(count)
+        for label, count in zip(Config.EMOTION_LABELS, emotion_totals)
+        if count
+    }
+    sentiment_distribution = {
+        label: int(count) for label, count in zip(Config.SENTIMENT_LABELS, sentiment_totals)
+    }
+    return emotion_counts, sentiment_distribution
+
+@njit(cache=True)
+def count_ids(ids: np.ndarray):
+    """Count occurrences of each id with an open-addressing hash table"""
+    size = 1
+    while size < 2 * ids.shape[0]:
+        size <<= 1
+    mask = size - 1
+    
+    keys = np.full(size, -1, dtype=np.int64)
+    counts = np.zeros(size, dtype=np.int64)
+    
+    for i in range(ids.shape[0]):
+        key = np.int64(ids[i])
+        slot = (key * 2654435761) & mask
+        while keys[slot] != -1 and keys[slot] != key:
+            slot = (slot + 1) & mask
+        keys[slot] = key
+        counts[slot] += 1
+    
+    return keys, counts
+
+def topk_counts(ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k most frequent ids and their counts, most frequent first"""
+    keys, counts = count_ids(ids)
+    occupied = keys >= 0
+    keys, counts = keys[occupied], counts[occupied]
+    
+    if len(counts) > k:
+        top = np.argpartition(-counts, k)[:k]
+    else:
+        top = np.arange(len(counts))
+    order = top[np.argsort(-counts[top], kind='stable')]
+    return keys[order], counts[order]
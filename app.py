@@ -1,22 +1,44 @@
 """Flask application with SocketIO for real-time chat and NLP analysis"""
+import logging
+import os
+
+from config import Config
+
+# Configure logging before patching so handler locks are native; the message
+# writer and ML worker log from OS threads, where green locks are unsafe
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# eventlet must patch the stdlib before Flask and the database are imported.
+# Callers blocked on inference occupy a tpool thread, so size the pool to the batch.
+os.environ.setdefault('EVENTLET_THREADPOOL_SIZE', str(Config.INFERENCE_MAX_BATCH * 2))
+import eventlet
+eventlet.monkey_patch()
+from eventlet import tpool
+
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from collections import defaultdict
 from datetime import datetime
-import json
-import logging
+from uuid import uuid4
+import time
 
-from config import Config
-from models import db, Message, User, AnalyticsSummary
+import numpy as np
+
+from sqlalchemy import func, select
+
+from models import db, Message, Entity, EntityText, User, AnalyticsSummary
 from ml_pipeline import ml_pipeline
+from message_writer import MessageWriter
+from analytics import encode_analysis, summarize, topk_counts
+from serialization import dumps, SocketJSON
+from shared_cache import SharedCache
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
@@ -29,8 +51,10 @@ db.init_app(app)
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*",
-    async_mode='threading',
-    logger=True,
+    async_mode=Config.SOCKETIO_ASYNC_MODE,
+    message_queue=Config.REDIS_URL,
+    json=SocketJSON,
+    logger=False,
     engineio_logger=False
 )
 
@@ -41,9 +65,21 @@ limiter = Limiter(
     default_limits=["200 per day", "50 per hour"]
 )
 
+# Persist messages off the request path
+message_writer = MessageWriter(app)
+
+# History and analytics shared across workers (disabled without REDIS_URL)
+shared_cache = SharedCache(Config.REDIS_URL)
+
 # Store active users per room
 active_users = {}
 
+# Reverse index: socket id -> rooms it has joined
+sid_to_rooms = defaultdict(set)
+
+# Recent analytics per room: room -> (latest message id, expiry, analytics)
+analytics_cache = {}
+
 @app.route('/')
 def index():
     """Serve the main chat interface"""
@@ -54,7 +90,8 @@ def health_check():
     """Health check endpoint"""
     return {
         'status': 'healthy',
-        'models_loaded': ml_pipeline._models_loaded,
+        'models_loaded': ml_pipeline.is_ready(),
+        'analysis_cache': ml_pipeline.cache_stats(),
         'timestamp': datetime.utcnow().isoformat()
     }
 
@@ -69,11 +106,11 @@ def handle_disconnect():
     """Handle client disconnection"""
     logger.info(f'Client disconnected: {request.sid}')
     
-    # Remove user from active users
-    for room, users in active_users.items():
+    # Remove the socket from the rooms it joined
+    for room in sid_to_rooms.pop(request.sid, ()):
+        users = active_users.get(room, {})
         if request.sid in users:
-            username = users[request.sid]
-            del users[request.sid]
+            username = users.pop(request.sid)
             emit('user_left', {'username': username, 'room': room}, room=room)
 
 @socketio.on('join')
@@ -88,6 +125,7 @@ def handle_join(data):
     if room not in active_users:
         active_users[room] = {}
     active_users[room][request.sid] = username
+    sid_to_rooms[request.sid].add(room)
     
     # Update user in database
     user = User.query.filter_by(username=username).first()
@@ -107,13 +145,18 @@ def handle_join(data):
     }, room=room)
     
     # Send recent messages to the user
-    recent_messages = Message.query.filter_by(room=room)\
-        .order_by(Message.timestamp.desc())\
-        .limit(50)\
-        .all()
+    history = shared_cache.get_history(room)
+    if history is None:
+        recent_messages = Message.query.filter_by(room=room)\
+            .order_by(Message.timestamp.desc())\
+            .limit(Config.MESSAGE_HISTORY_SIZE)\
+            .all()
+        history = [msg.to_dict() for msg in reversed(recent_messages)]
+        # Seeds Redis only if the room's list is still missing
+        shared_cache.set_history(room, history)
     
     emit('message_history', {
-        'messages': [msg.to_dict() for msg in reversed(recent_messages)]
+        'messages': history
     })
 
 @socketio.on('leave')
@@ -127,6 +170,7 @@ def handle_leave(data):
     # Remove from active users
     if room in active_users and request.sid in active_users[room]:
         del active_users[room][request.sid]
+    sid_to_rooms[request.sid].discard(room)
     
     logger.info(f'{username} left room: {room}')
     emit('user_left', {'username': username, 'room': room}, room=room)
@@ -150,39 +194,47 @@ def handle_message(data):
         
         logger.info(f'Message from {username} in {room}: {text[:50]}...')
         
-        # Run NLP analysis
-        analysis = ml_pipeline.analyze_message(text)
+        # Run NLP analysis on a native thread so the event loop keeps serving sockets
+        analysis = tpool.execute(ml_pipeline.analyze_message, text)
         
-        # Save to database
-        message = Message(
-            username=username,
-            room=room,
-            text=text,
-            emotion=analysis['emotion'],
-            emotion_scores=json.dumps(analysis['emotion_scores']),
-            entities=json.dumps(analysis['entities']),
-            aspect_sentiment=json.dumps(analysis['aspect_sentiment'])
-        )
-        db.session.add(message)
-        
-        # Update user message count
-        user = User.query.filter_by(username=username).first()
-        if user:
-            user.message_count += 1
-            user.last_active = datetime.utcnow()
-        
-        db.session.commit()
+        # Queue for the background writer (no fsync on the request path)
+        message_id = str(uuid4())
+        timestamp = datetime.utcnow()
+        message_writer.submit({
+            'uuid': message_id,
+            'username': username,
+            'room': room,
+            'text': text,
+            'timestamp': timestamp,
+            'emotion': analysis['emotion'],
+            'emotion_scores': dumps(analysis['emotion_scores']),
+            'entities': dumps(analysis['entities']),
+            'aspect_sentiment': dumps(analysis['aspect_sentiment']),
+            **encode_analysis(analysis)
+        }, analysis['entities'])
         
         # Prepare response
         response = {
-            'id': message.id,
+            'id': message_id,
             'username': username,
             'room': room,
             'text': text,
-            'timestamp': message.timestamp.isoformat(),
+            'timestamp': timestamp.isoformat(),
             'analysis': analysis
         }
         
+        shared_cache.push_message(room, {
+            'id': message_id,
+            'username': username,
+            'room': room,
+            'text': text,
+            'timestamp': response['timestamp'],
+            'emotion': analysis['emotion'],
+            'emotion_scores': analysis['emotion_scores'],
+            'entities': analysis['entities'],
+            'aspect_sentiment': analysis['aspect_sentiment']
+        })
+        
         # Broadcast to room
         emit('new_message', response, room=room)
         
@@ -201,37 +253,54 @@ def handle_get_analytics(data):
     try:
         room = data.get('room', 'general')
         
-        # Get recent messages for analysis
-        messages = Message.query.filter_by(room=room)\
+        # Analytics computed recently by any worker
+        analytics = shared_cache.get_analytics(room)
+        if analytics is not None:
+            emit('analytics_update', analytics)
+            return
+        
+        # Serve the cached result while the room has no new messages
+        latest_id = db.session.execute(
+            select(func.max(Message.id)).where(Message.room == room)
+        ).scalar()
+        cached = analytics_cache.get(room)
+        if cached and cached[0] == latest_id and cached[1] > time.monotonic():
+            emit('analytics_update', cached[2])
+            return
+        
+        # Get recent messages for analysis (only the columns we aggregate)
+        recent = select(Message.id)\
+            .where(Message.room == room)\
             .order_by(Message.timestamp.desc())\
-            .limit(Config.MAX_RECENT_MESSAGES)\
-            .all()
+            .limit(Config.MAX_RECENT_MESSAGES)
         
-        # Aggregate emotion data
-        emotion_counts = {}
-        entity_counts = {}
-        aspect_sentiments = {'positive': 0, 'negative': 0, 'neutral': 0}
+        messages = db.session.execute(
+            recent.with_only_columns(
+                Message.emotion_idx,
+                Message.sentiment_positive,
+                Message.sentiment_negative,
+                Message.sentiment_neutral
+            )
+        ).all()
         
-        for msg in messages:
-            # Emotion counts
-            if msg.emotion:
-                emotion_counts[msg.emotion] = emotion_counts.get(msg.emotion, 0) + 1
-            
-            # Entity counts
-            if msg.entities:
-                entities = json.loads(msg.entities)
-                for entity in entities:
-                    entity_text = entity['text']
-                    entity_counts[entity_text] = entity_counts.get(entity_text, 0) + 1
-            
-            # Aspect sentiment counts
-            if msg.aspect_sentiment:
-                aspects = json.loads(msg.aspect_sentiment)
-                for aspect, sentiment in aspects.items():
-                    aspect_sentiments[sentiment] = aspect_sentiments.get(sentiment, 0) + 1
+        # Aggregate emotion and sentiment counts from the precomputed columns
+        emotion_counts, aspect_sentiments = summarize(messages)
         
         # Get top entities
-        top_entities = sorted(entity_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+        recent_ids = recent.subquery()
+        entity_ids = db.session.execute(
+            select(Entity.text_id)
+            .where(Entity.room == room, Entity.message_id.in_(select(recent_ids.c.id)))
+        ).scalars().all()
+        top_ids, top_counts = topk_counts(np.array(entity_ids, dtype=np.int32), 10)
+        
+        entity_texts = dict(db.session.execute(
+            select(EntityText.id, EntityText.text).where(EntityText.id.in_(top_ids.tolist()))
+        ).all())
+        top_entities = [
+            (entity_texts[text_id], count)
+            for text_id, count in zip(top_ids.tolist(), top_counts.tolist())
+        ]
         
         # Prepare analytics response
         analytics = {
@@ -242,6 +311,8 @@ def handle_get_analytics(data):
             'sentiment_distribution': aspect_sentiments,
             'timestamp': datetime.utcnow().isoformat()
         }
+        analytics_cache[room] = (latest_id, time.monotonic() + Config.ANALYTICS_UPDATE_INTERVAL, analytics)
+        shared_cache.set_analytics(room, analytics)
         
         emit('analytics_update', analytics)
         
@@ -270,11 +341,18 @@ def init_app():
         db.create_all()
         logger.info("✅ Database tables created")
         
-        # Load ML models
-        logger.info("Loading ML models (this may take a minute)...")
-        ml_pipeline.load_models()
+        message_writer.start()
+        
+        if Config.PRELOAD_MODELS and not ml_pipeline._ready.is_set():
+            # ML models load in a background thread started by ml_pipeline
+            logger.info("Loading ML models in the background (this may take a minute)...")
+            return
+        
+        if not Config.PRELOAD_MODELS:
+            logger.info("Loading ML models (this may take a minute)...")
+            ml_pipeline.load_models()
         
-        if ml_pipeline._models_loaded:
+        if ml_pipeline.is_ready():
             logger.info("✅ All systems ready!")
         else:
             logger.warning("⚠️ Models not loaded - app will run with limited functionality")
@@ -282,7 +360,6 @@ def init_app():
 if __name__ == '__main__':
     # Initialize app
     init_app()
-    import os
     port = int(os.environ.get('PORT', 5000))
     # Run with SocketIO
     logger.info("🚀 Starting Chat Intelligence System...")
@@ -16,23 +16,58 @@ class Config:
         f'sqlite:///{BASE_DIR / "chat_intelligence.db"}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Write-behind message persistence
+    MESSAGE_WRITE_BATCH_SIZE = 50  # messages per commit
+    MESSAGE_FLUSH_INTERVAL = 0.1  # seconds
+    MESSAGE_WRITE_RETRIES = 3  # whole-batch attempts before committing row by row
+    MESSAGE_WRITE_RETRY_DELAY = 0.05  # seconds, multiplied by the attempt number
+    
+    # Redis (optional): shared history/analytics cache and SocketIO message queue
+    REDIS_URL = os.environ.get('REDIS_URL')  # e.g. redis://localhost:6379/0
+    MESSAGE_HISTORY_SIZE = 50  # messages sent to a user on join
+    
     # SocketIO settings
-    SOCKETIO_ASYNC_MODE = 'threading'
+    SOCKETIO_ASYNC_MODE = 'eventlet'
     SOCKETIO_CORS_ALLOWED_ORIGINS = "*"  # Change in production
     
     # ML Models settings
     EMOTION_MODEL = 'j-hartmann/emotion-english-distilroberta-base'
+    SENTIMENT_MODEL = 'distilbert-base-uncased-finetuned-sst-2-english'
     SPACY_MODEL = 'en_core_web_sm'
+    EMOTION_LABELS = ['anger', 'disgust', 'fear', 'joy', 'neutral', 'sadness', 'surprise']
+    SENTIMENT_LABELS = ['positive', 'negative', 'neutral']
+    # Only NER is used; its own internal tok2vec means the shared one can go too
+    SPACY_EXCLUDED_PIPES = ['tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer']
+    SPACY_MAX_LENGTH = 10000  # characters; chat messages are far shorter
+    NER_CACHE_SIZE = 8192  # distinct short texts kept in the NER cache
+    NER_CACHE_MAX_TEXT_LENGTH = 128  # only texts shorter than this are cached
     
     # Model optimization
-    USE_ONNX = False  # Set to True after conversion
+    USE_ONNX = os.environ.get('USE_ONNX', 'False').lower() in ('1', 'true', 'yes')
+    ONNX_MODEL_DIR = BASE_DIR / 'onnx_models'  # INT8-quantized exports are cached here
+    TORCH_NUM_THREADS = max(1, (os.cpu_count() or 2) // 2)
+    TORCH_JIT_TRACE = True  # TorchScript-trace PyTorch models at load time
     MAX_MESSAGE_LENGTH = 500
+    MAX_SEQUENCE_TOKENS = 128  # ~MAX_MESSAGE_LENGTH characters of chat text
+    
+    # Load models in a background thread when ml_pipeline is imported (which
+    # happens on any `import app`); scripts like init_db.py turn this off
+    PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', 'True').lower() in ('1', 'true', 'yes')
+    MODEL_LOAD_TIMEOUT = 30  # seconds a message waits for models still loading
+    
+    # Inference batching
+    INFERENCE_MAX_BATCH = 32  # max messages per forward pass
+    INFERENCE_BATCH_WINDOW = 0.01  # seconds to wait for more messages
+    SENTIMENT_MAX_BATCH = 64  # max entity contexts per sentiment forward pass
+    INFERENCE_QUEUE_SIZE = 1024  # pending messages before callers block
+    INFERENCE_TIMEOUT = 30  # seconds
+    ANALYSIS_CACHE_SIZE = 4096  # distinct message texts kept in the LRU cache
     
     # Rate limiting
     RATE_LIMIT_MESSAGES = "10/minute"
     
     # Analytics settings
-    ANALYTICS_UPDATE_INTERVAL = 2  # seconds
+    ANALYTICS_UPDATE_INTERVAL = 2  # seconds, also the analytics cache TTL
     MAX_RECENT_MESSAGES = 100
     
     # Logging
@@ -1,6 +1,11 @@
 """Initialize database"""
+import os
+
+# Creating tables doesn't need the ML models; skip the import-time background load
+os.environ.setdefault('PRELOAD_MODELS', 'False')
+
 from app import app, db
-from models import Message, User, AnalyticsSummary
+from models import Message, Entity, EntityText, User, AnalyticsSummary
 
 def init_database():
     """Create all database tables"""
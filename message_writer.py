@@ -0,0 +1,188 @@
+"""Write-behind persistence for chat messages"""
+import atexit
+import logging
+from collections import Counter
+from typing import Dict, List, Sequence, Set, Tuple
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from config import Config
+from models import Message, Entity, EntityText, User
+
+try:
+    # Commit on a native OS thread so blocking database I/O doesn't stall the eventlet hub
+    from eventlet.patcher import original
+    queue = original('queue')
+    threading = original('threading')
+    time = original('time')
+except ImportError:
+    import queue
+    import threading
+    import time
+
+logger = logging.getLogger(__name__)
+
+# Queued after the last message to make the writer flush and exit
+_STOP = object()
+
+class MessageWriter:
+    """Buffers message inserts and commits them in batches on a background thread
+    
+    The writer runs on a native OS thread, so it must not share Flask-SQLAlchemy's
+    session or connection pool: under eventlet their locks are green and unsafe
+    across threads. It uses a private engine with NullPool (a fresh connection per
+    session, no shared pool locks) instead.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self._queue = queue.Queue()
+        self._thread = None
+        self._session_factory = None
+    
+    def start(self):
+        """Start the background committer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._session_factory is None:
+            engine = create_engine(self.app.config['SQLALCHEMY_DATABASE_URI'], poolclass=NullPool)
+            self._session_factory = sessionmaker(bind=engine)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='message-writer',
+            daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.stop)
+    
+    def stop(self, timeout: float = 10):
+        """Flush every queued message and stop the writer (also run at interpreter exit)"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f'Message writer did not finish flushing within {timeout}s')
+    
+    def submit(self, message: Dict, entities: Sequence[Dict] = ()):
+        """Queue a message row (column name -> value) and its entities for the next batch commit"""
+        if self._thread is None:
+            self.start()
+        self._queue.put((message, entities))
+    
+    def _run(self):
+        """Collect queued messages until the batch is full or the flush interval expires"""
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self._queue.get()
+            deadline = time.monotonic() + Config.MESSAGE_FLUSH_INTERVAL
+            
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= Config.MESSAGE_WRITE_BATCH_SIZE:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            
+            if stopping:
+                # Drain anything submitted before shutdown
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+            
+            if batch:
+                self._flush(batch)
+    
+    def _flush(self, batch: List[Tuple[Dict, Sequence[Dict]]]):
+        """Commit a batch, retrying it whole before falling back to one message per commit"""
+        for attempt in range(1, Config.MESSAGE_WRITE_RETRIES + 1):
+            try:
+                self._write(batch)
+                return
+            except Exception as e:
+                logger.warning(f'Saving {len(batch)} messages failed (attempt {attempt}): {e}')
+                time.sleep(Config.MESSAGE_WRITE_RETRY_DELAY * attempt)
+        
+        # Isolate the bad rows so they don't take the rest of the batch down
+        for item in batch:
+            try:
+                self._write([item])
+            except Exception as e:
+                message = item[0]
+                logger.error(
+                    f"Dropping message {message.get('uuid')} from {message.get('username')} "
+                    f"in {message.get('room')}: {e}",
+                    exc_info=True
+                )
+    
+    def _write(self, batch: List[Tuple[Dict, Sequence[Dict]]]):
+        """Insert messages, their entities and user counters in one transaction"""
+        with self._session_factory() as session, session.begin():
+            # return_defaults fills in ids for the entity rows
+            messages = [Message(**message) for message, _ in batch]
+            session.bulk_save_objects(messages, return_defaults=True)
+            
+            text_ids = self._intern_entity_texts(session, {
+                entity['text'][:200] for _, entities in batch for entity in entities
+            })
+            session.bulk_insert_mappings(Entity, [
+                {
+                    'message_id': message.id,
+                    'room': message.room,
+                    'text_id': text_ids[entity['text'][:200]],
+                    'label': entity['label']
+                }
+                for message, (_, entities) in zip(messages, batch)
+                for entity in entities
+            ])
+            
+            # Update user message counts
+            counts = Counter(message.username for message in messages)
+            last_active = {}
+            for message in messages:
+                last_active[message.username] = message.timestamp
+            
+            for username, count in counts.items():
+                session.query(User).filter_by(username=username).update({
+                    User.message_count: User.message_count + count,
+                    User.last_active: last_active[username]
+                }, synchronize_session=False)
+    
+    @staticmethod
+    def _intern_entity_texts(session: Session, texts: Set[str]) -> Dict[str, int]:
+        """Map entity strings to dictionary ids, inserting the ones not seen before"""
+        if not texts:
+            return {}
+        
+        lookup = select(EntityText.text, EntityText.id).where(EntityText.text.in_(texts))
+        text_ids = dict(session.execute(lookup).all())
+        
+        new_texts = [{'text': text} for text in texts if text not in text_ids]
+        if new_texts:
+            # Another worker may insert the same strings concurrently, so skip
+            # conflicting rows instead of failing, then read back every id
+            if session.get_bind().dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            session.execute(
+                insert(EntityText).values(new_texts).on_conflict_do_nothing(index_elements=['text'])
+            )
+            text_ids = dict(session.execute(lookup).all())
+        
+        return text_ids
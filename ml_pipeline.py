@@ -1,12 +1,77 @@
 """ML Pipeline for NLP Analysis"""
+import copy
+import functools
 import logging
+import os
+import time
+from collections import OrderedDict
 from typing import Dict, List, Optional
 import numpy as np
 
+from config import Config
+
+# Let the Rust tokenizers parallelize batched encoding (must be set before import)
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
+try:
+    # Keep inference on native OS threads even when eventlet has patched the stdlib
+    from eventlet.patcher import original
+    queue = original('queue')
+    threading = original('threading')
+except ImportError:
+    import queue
+    import threading
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class _PendingResult:
+    """Result slot filled in by the batching worker thread"""
+    
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+    
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+    
+    def set_exception(self, error: Exception):
+        self._error = error
+        self._done.set()
+    
+    def result(self, timeout: Optional[float] = None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('Timed out waiting for batched inference')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class _LRUCache:
+    """Thread-safe LRU mapping that, unlike functools.lru_cache, can be filled explicitly"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Cached value for key, or None on a miss"""
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
 class MLPipeline:
     """Manages all ML models and provides unified analysis interface"""
     
@@ -17,6 +82,18 @@ class MLPipeline:
         self.sentiment_model = None
         self.sentiment_tokenizer = None
         self._models_loaded = False
+        self._ready = threading.Event()  # set once load_models has finished
+        self.use_onnx = False
+        self.max_tokens = Config.MAX_SEQUENCE_TOKENS
+        
+        # Memoized NER for short, frequently repeated messages
+        self._ner_cache = _LRUCache(Config.NER_CACHE_SIZE)
+        
+        # Batching worker state (started once models are loaded)
+        self._queue = queue.Queue(maxsize=Config.INFERENCE_QUEUE_SIZE)
+        self._sent_queue = queue.Queue()  # messages waiting for aspect sentiment
+        self._worker = None
+        self._sent_worker = None
         
     def load_models(self):
         """Load all ML models at startup"""
@@ -24,183 +101,470 @@ class MLPipeline:
             logger.info("Loading ML models...")
             
             # 1. Load Emotion Detection Model (GoEmotions)
-            from transformers import AutoTokenizer, AutoModelForSequenceClassification
+            self.use_onnx = Config.USE_ONNX and self._onnx_available()
+            if not self.use_onnx:
+                self._configure_torch()
             logger.info("Loading emotion detection model...")
-            self.emotion_tokenizer = AutoTokenizer.from_pretrained(
-                'j-hartmann/emotion-english-distilroberta-base'
-            )
-            self.emotion_model = AutoModelForSequenceClassification.from_pretrained(
-                'j-hartmann/emotion-english-distilroberta-base'
-            )
-            self.emotion_labels = [
-                'anger', 'disgust', 'fear', 'joy', 'neutral', 'sadness', 'surprise'
-            ]
+            self.emotion_tokenizer = self._load_tokenizer(Config.EMOTION_MODEL)
+            self.emotion_model = self._load_classifier(Config.EMOTION_MODEL, self.emotion_tokenizer)
+            self.emotion_labels = Config.EMOTION_LABELS
+            self.max_tokens = min(Config.MAX_SEQUENCE_TOKENS, self.emotion_tokenizer.model_max_length)
             
             # 2. Load NER Model (spaCy)
             import spacy
             logger.info("Loading NER model...")
             try:
-                self.ner_model = spacy.load('en_core_web_sm')
+                # Only the NER component is used, so don't even load the rest of the pipeline
+                self.ner_model = spacy.load(Config.SPACY_MODEL, exclude=Config.SPACY_EXCLUDED_PIPES)
+                self.ner_model.max_length = Config.SPACY_MAX_LENGTH
             except OSError:
                 logger.warning("spaCy model not found. Run: python -m spacy download en_core_web_sm")
                 self.ner_model = None
             
             # 3. Load Sentiment Model for Aspect Analysis
             logger.info("Loading sentiment model for aspect analysis...")
-            self.sentiment_tokenizer = AutoTokenizer.from_pretrained(
-                'distilbert-base-uncased-finetuned-sst-2-english'
-            )
-            self.sentiment_model = AutoModelForSequenceClassification.from_pretrained(
-                'distilbert-base-uncased-finetuned-sst-2-english'
-            )
+            self.sentiment_tokenizer = self._load_tokenizer(Config.SENTIMENT_MODEL)
+            self.sentiment_model = self._load_classifier(Config.SENTIMENT_MODEL, self.sentiment_tokenizer)
             
             self._models_loaded = True
+            self._start_worker()
             logger.info("✅ All models loaded successfully!")
             
         except Exception as e:
             logger.error(f"Error loading models: {e}")
             self._models_loaded = False
+        finally:
+            self._ready.set()
+    
+    def is_ready(self) -> bool:
+        """Whether model loading has finished successfully"""
+        return self._ready.is_set() and self._models_loaded
+    
+    @staticmethod
+    def _onnx_available() -> bool:
+        """Check whether the ONNX Runtime toolchain is installed"""
+        try:
+            import onnxruntime  # noqa: F401
+            import optimum.onnxruntime  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("USE_ONNX is set but onnxruntime/optimum are not installed, using PyTorch")
+            return False
+    
+    @staticmethod
+    def _load_tokenizer(model_name: str):
+        """Load the fast (Rust) tokenizer for a model"""
+        from transformers import AutoTokenizer
+        
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if not tokenizer.is_fast:
+            logger.warning(f"Fast tokenizer unavailable for {model_name}, install 'tokenizers'")
+        return tokenizer
+    
+    @staticmethod
+    def _configure_torch():
+        """Pin intra-op threads and avoid oversubscription with the batching worker"""
+        import torch
+        
+        torch.set_num_threads(Config.TORCH_NUM_THREADS)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started
+            pass
+    
+    def _load_classifier(self, model_name: str, tokenizer):
+        """Load a sequence classifier as an ONNX Runtime session or a PyTorch module"""
+        if self.use_onnx:
+            return self._load_onnx_session(model_name)
+        
+        from transformers import AutoModelForSequenceClassification
+        model = AutoModelForSequenceClassification.from_pretrained(
+            model_name,
+            torchscript=Config.TORCH_JIT_TRACE
+        )
+        model.eval()
+        
+        if Config.TORCH_JIT_TRACE:
+            model = self._trace_model(model, tokenizer)
+        return model
+    
+    @staticmethod
+    def _trace_model(model, tokenizer):
+        """Trace a PyTorch classifier with TorchScript, falling back to eager mode"""
+        import torch
+        
+        # Two texts of different lengths so padding and attention masks are traced
+        example_inputs = tokenizer(
+            ['Hello there!', 'Representative chat message used to trace the model graph.'],
+            return_tensors='pt',
+            padding=True,
+            truncation=True
+        )
+        
+        try:
+            with torch.inference_mode():
+                return torch.jit.trace(model, example_kwarg_inputs=dict(example_inputs), strict=False)
+        except Exception as e:
+            logger.warning(f"TorchScript tracing failed, using eager model: {e}")
+            return model
+    
+    def _load_onnx_session(self, model_name: str):
+        """Export a model to ONNX with dynamic INT8 quantization and open an inference session"""
+        import onnxruntime as ort
+        
+        export_dir = Config.ONNX_MODEL_DIR / model_name.replace('/', '--')
+        quantized_path = export_dir / 'model_quantized.onnx'
+        
+        if not quantized_path.exists():
+            from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            
+            logger.info(f"Exporting {model_name} to ONNX with INT8 quantization...")
+            ort_model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+            quantizer = ORTQuantizer.from_pretrained(ort_model)
+            quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=export_dir, quantization_config=quantization_config)
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(
+            str(quantized_path),
+            sess_options=options,
+            providers=['CPUExecutionProvider']
+        )
+    
+    def _predict_proba(self, model, tokenizer, texts: List[str]) -> np.ndarray:
+        """Tokenize texts, run the classifier once and return class probabilities"""
+        if self.use_onnx:
+            inputs = tokenizer(
+                texts,
+                return_tensors='np',
+                padding='longest',
+                truncation=True,
+                max_length=self.max_tokens
+            )
+            feed = {arg.name: inputs[arg.name].astype(np.int64) for arg in model.get_inputs()}
+            logits = model.run(None, feed)[0]
             
+            # Numerically stable softmax
+            exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+            return exp / exp.sum(axis=-1, keepdims=True)
+        
+        import torch
+        
+        inputs = tokenizer(
+            texts,
+            return_tensors='pt',
+            padding='longest',
+            truncation=True,
+            max_length=self.max_tokens
+        )
+        
+        with torch.inference_mode():
+            # Traced and torchscript models return a tuple with logits first
+            logits = model(**inputs)[0]
+            probs = torch.nn.functional.softmax(logits, dim=-1)
+        
+        return probs.numpy()
+    
+    def _start_worker(self):
+        """Start the background threads that batch queued messages"""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._worker = threading.Thread(
+            target=self._batch_worker,
+            name='ml-batch-worker',
+            daemon=True
+        )
+        self._sent_worker = threading.Thread(
+            target=self._sentiment_worker,
+            name='ml-sentiment-worker',
+            daemon=True
+        )
+        self._worker.start()
+        self._sent_worker.start()
+    
+    @staticmethod
+    def _drain(pending: queue.Queue, limit: int, size=lambda item: 1) -> list:
+        """Block for one item, then collect more until limit is reached or the batch window expires"""
+        batch = [pending.get()]
+        total = size(batch[0])
+        deadline = time.monotonic() + Config.INFERENCE_BATCH_WINDOW
+        
+        while total < limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            total += size(item)
+        
+        return batch
+    
+    def _batch_worker(self):
+        """Run emotion detection and NER on batches, then hand messages to the sentiment stage"""
+        while True:
+            batch = self._drain(self._queue, Config.INFERENCE_MAX_BATCH)
+            
+            texts = [text for text, _ in batch]
+            try:
+                # strict: errors fail the futures so degraded results are never cached
+                emotion_results = self.detect_emotion_batch(texts, strict=True)
+                entities_list = self.extract_entities_batch(texts, strict=True)
+            except Exception as e:
+                logger.error(f"Batch analysis error: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            for (text, future), emotion_result, entities in zip(batch, emotion_results, entities_list):
+                result = {
+                    'emotion': emotion_result['primary_emotion'],
+                    'emotion_scores': emotion_result['scores'],
+                    'entities': entities,
+                    'aspect_sentiment': {}
+                }
+                if entities:
+                    self._sent_queue.put((text, result, future))
+                else:
+                    future.set_result(result)
+    
+    def _sentiment_worker(self):
+        """Classify entity contexts from many messages with one forward pass per drain cycle"""
+        while True:
+            batch = self._drain(
+                self._sent_queue,
+                Config.SENTIMENT_MAX_BATCH,
+                size=lambda item: len(item[1]['entities'])
+            )
+            
+            try:
+                aspect_results = self.analyze_aspect_sentiment_batch(
+                    [text for text, _, _ in batch],
+                    [result['entities'] for _, result, _ in batch],
+                    strict=True
+                )
+            except Exception as e:
+                logger.error(f"Batch aspect sentiment error: {e}")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            for (_, result, future), aspect_sentiment in zip(batch, aspect_results):
+                result['aspect_sentiment'] = aspect_sentiment
+                future.set_result(result)
+    
+    @staticmethod
+    def _default_analysis() -> Dict[str, any]:
+        """Analysis result used when models are unavailable or inference fails"""
+        return {
+            'emotion': 'neutral',
+            'emotion_scores': {},
+            'entities': [],
+            'aspect_sentiment': {}
+        }
+    
     def detect_emotion(self, text: str) -> Dict[str, any]:
         """Detect emotions in text using GoEmotions model"""
+        return self.detect_emotion_batch([text])[0]
+    
+    def detect_emotion_batch(self, texts: List[str], strict: bool = False) -> List[Dict[str, any]]:
+        """Detect emotions for several texts with a single forward pass
+        
+        With strict=True inference errors are raised instead of returning neutral defaults.
+        """
         if not self._models_loaded or self.emotion_model is None:
-            return {'primary_emotion': 'neutral', 'scores': {}}
+            return [{'primary_emotion': 'neutral', 'scores': {}} for _ in texts]
         
         try:
-            import torch
+            # Tokenize the whole batch and run inference once
+            probs = self._predict_proba(self.emotion_model, self.emotion_tokenizer, texts)
             
-            # Tokenize and run inference
-            inputs = self.emotion_tokenizer(text, return_tensors='pt', truncation=True, max_length=512)
+            # Get primary emotion (highest score) for the whole batch at once
+            primary_indices = probs.argmax(axis=1).tolist()
             
-            with torch.no_grad():
-                outputs = self.emotion_model(**inputs)
-                probs = torch.nn.functional.softmax(outputs.logits, dim=-1)
-            
-            # Get scores for all emotions
-            scores = probs[0].tolist()
-            emotion_scores = {label: float(score) for label, score in zip(self.emotion_labels, scores)}
-            
-            # Get primary emotion (highest score)
-            primary_idx = np.argmax(scores)
-            primary_emotion = self.emotion_labels[primary_idx]
-            primary_score = scores[primary_idx]
+            results = []
+            for scores, primary_idx in zip(probs.tolist(), primary_indices):
+                # Get scores for all emotions
+                emotion_scores = dict(zip(self.emotion_labels, scores))
+                results.append({
+                    'primary_emotion': self.emotion_labels[primary_idx],
+                    'confidence': scores[primary_idx],
+                    'scores': emotion_scores
+                })
             
-            return {
-                'primary_emotion': primary_emotion,
-                'confidence': primary_score,
-                'scores': emotion_scores
-            }
+            return results
             
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"Emotion detection error: {e}")
-            return {'primary_emotion': 'neutral', 'scores': {}}
+            return [{'primary_emotion': 'neutral', 'scores': {}} for _ in texts]
+    
+    @staticmethod
+    def _doc_entities(doc) -> List[Dict[str, any]]:
+        """Convert a spaCy Doc's entities to serializable dicts"""
+        return [
+            {
+                'text': ent.text,
+                'label': ent.label_,
+                'start': ent.start_char,
+                'end': ent.end_char
+            }
+            for ent in doc.ents
+        ]
     
     def extract_entities(self, text: str) -> List[Dict[str, any]]:
         """Extract named entities using spaCy"""
+        return self.extract_entities_batch([text])[0]
+    
+    def extract_entities_batch(self, texts: List[str], strict: bool = False) -> List[List[Dict[str, any]]]:
+        """Extract named entities for several texts with spaCy's batched nlp.pipe
+        
+        With strict=True NER errors are raised instead of returning empty lists.
+        """
         if not self._models_loaded or self.ner_model is None:
-            return []
+            return [[] for _ in texts]
         
         try:
-            doc = self.ner_model(text)
-            
-            entities = []
-            for ent in doc.ents:
-                entities.append({
-                    'text': ent.text,
-                    'label': ent.label_,
-                    'start': ent.start_char,
-                    'end': ent.end_char
-                })
+            results = [None] * len(texts)
+            
+            # Serve short texts from the cache; every miss goes through one nlp.pipe call
+            misses = []
+            for i, text in enumerate(texts):
+                cached = self._ner_cache.get(text) if len(text) < Config.NER_CACHE_MAX_TEXT_LENGTH else None
+                if cached is not None:
+                    results[i] = [dict(entity) for entity in cached]
+                else:
+                    misses.append(i)
+            
+            if misses:
+                docs = self.ner_model.pipe(
+                    [texts[i] for i in misses],
+                    batch_size=Config.INFERENCE_MAX_BATCH,
+                    n_process=1
+                )
+                for i, doc in zip(misses, docs):
+                    results[i] = self._doc_entities(doc)
+                    if len(texts[i]) < Config.NER_CACHE_MAX_TEXT_LENGTH:
+                        self._ner_cache.put(texts[i], tuple(dict(entity) for entity in results[i]))
             
-            return entities
+            return results
             
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"NER error: {e}")
-            return []
+            return [[] for _ in texts]
+    
+    @staticmethod
+    def _aspect_contexts(text: str, entities: List[Dict]) -> List[str]:
+        """Extract the context window around each entity (simple window approach)"""
+        contexts = []
+        for entity in entities:
+            start = max(0, entity['start'] - 50)
+            end = min(len(text), entity['end'] + 50)
+            contexts.append(text[start:end])
+        return contexts
+    
+    def _classify_sentiment(self, contexts: List[str]) -> List[str]:
+        """Classify a list of contexts as positive/negative/neutral in one forward pass"""
+        probs = self._predict_proba(self.sentiment_model, self.sentiment_tokenizer, contexts)
+        
+        sentiments = []
+        for row in probs:
+            # Labels: [negative, positive]
+            negative_score = float(row[0])
+            positive_score = float(row[1])
+            
+            # Determine sentiment
+            if positive_score > 0.6:
+                sentiments.append('positive')
+            elif negative_score > 0.6:
+                sentiments.append('negative')
+            else:
+                sentiments.append('neutral')
+        
+        return sentiments
     
     def analyze_aspect_sentiment(self, text: str, entities: List[Dict]) -> Dict[str, str]:
         """Analyze sentiment for each detected entity/aspect"""
-        if not self._models_loaded or self.sentiment_model is None:
-            return {}
+        return self.analyze_aspect_sentiment_batch([text], [entities])[0]
+    
+    def analyze_aspect_sentiment_batch(self, texts: List[str], entities_list: List[List[Dict]],
+                                       strict: bool = False) -> List[Dict[str, str]]:
+        """Analyze aspect sentiment for several messages with a single forward pass
+        
+        With strict=True inference errors are raised instead of returning empty results.
+        """
+        results = [{} for _ in texts]
+        if not self._models_loaded or self.sentiment_model is None or not any(entities_list):
+            return results
         
         try:
-            import torch
-            
-            aspect_sentiments = {}
-            
-            # For each entity, analyze sentiment in context
-            for entity in entities:
-                entity_text = entity['text']
-                
-                # Extract context around entity (simple window approach)
-                start = max(0, entity['start'] - 50)
-                end = min(len(text), entity['end'] + 50)
-                context = text[start:end]
-                
-                # Run sentiment analysis
-                inputs = self.sentiment_tokenizer(
-                    context, 
-                    return_tensors='pt', 
-                    truncation=True, 
-                    max_length=512
-                )
-                
-                with torch.no_grad():
-                    outputs = self.sentiment_model(**inputs)
-                    probs = torch.nn.functional.softmax(outputs.logits, dim=-1)
-                
-                # Labels: [negative, positive]
-                negative_score = probs[0][0].item()
-                positive_score = probs[0][1].item()
-                
-                # Determine sentiment
-                if positive_score > 0.6:
-                    sentiment = 'positive'
-                elif negative_score > 0.6:
-                    sentiment = 'negative'
-                else:
-                    sentiment = 'neutral'
-                
-                aspect_sentiments[entity_text] = sentiment
+            # Flatten the entity contexts of every message into one batch,
+            # classifying each distinct context window only once
+            context_index = {}
+            owners = []
+            for i, (text, entities) in enumerate(zip(texts, entities_list)):
+                for entity, context in zip(entities, self._aspect_contexts(text, entities)):
+                    idx = context_index.setdefault(context, len(context_index))
+                    owners.append((i, entity['text'], idx))
+            
+            sentiments = self._classify_sentiment(list(context_index))
+            for i, entity_text, idx in owners:
+                results[i][entity_text] = sentiments[idx]
             
-            return aspect_sentiments
+            return results
             
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"Aspect sentiment error: {e}")
-            return {}
+            return [{} for _ in texts]
     
     def analyze_message(self, text: str) -> Dict[str, any]:
         """Run complete NLP analysis pipeline on a message"""
+        # Models may still be loading in the background
+        self._ready.wait(timeout=Config.MODEL_LOAD_TIMEOUT)
         if not self._models_loaded:
             logger.warning("Models not loaded, returning default values")
-            return {
-                'emotion': 'neutral',
-                'emotion_scores': {},
-                'entities': [],
-                'aspect_sentiment': {}
-            }
+            return self._default_analysis()
         
         try:
-            # Run all analyses
-            emotion_result = self.detect_emotion(text)
-            entities = self.extract_entities(text)
-            aspect_sentiment = self.analyze_aspect_sentiment(text, entities)
-            
-            return {
-                'emotion': emotion_result['primary_emotion'],
-                'emotion_scores': emotion_result['scores'],
-                'entities': entities,
-                'aspect_sentiment': aspect_sentiment
-            }
+            # Copy so callers can't mutate the cached result
+            return copy.deepcopy(self._analyze_message_cached(text))
             
         except Exception as e:
             logger.error(f"Message analysis error: {e}")
-            return {
-                'emotion': 'neutral',
-                'emotion_scores': {},
-                'entities': [],
-                'aspect_sentiment': {}
-            }
+            return self._default_analysis()
+    
+    @functools.lru_cache(maxsize=Config.ANALYSIS_CACHE_SIZE)
+    def _analyze_message_cached(self, text: str) -> Dict[str, any]:
+        """Analyze a message through the batching worker, memoized on the exact text"""
+        # Hand the message to the batching worker and wait for its result
+        future = _PendingResult()
+        self._queue.put((text, future), timeout=Config.INFERENCE_TIMEOUT)
+        return future.result(timeout=Config.INFERENCE_TIMEOUT)
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit/miss counters for the analysis result cache"""
+        info = self._analyze_message_cached.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'max_size': info.maxsize
+        }
 
 # Global ML pipeline instance
 ml_pipeline = MLPipeline()
+
+# Load models in the background so the server can start accepting connections
+if Config.PRELOAD_MODELS:
+    _load_thread = threading.Thread(target=ml_pipeline.load_models, name='ml-model-loader', daemon=True)
+    _load_thread.start()
@@ -1,15 +1,33 @@
 """Database models for Chat Intelligence System"""
 from datetime import datetime
+from uuid import uuid4
 from flask_sqlalchemy import SQLAlchemy
-import json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
+
+from serialization import loads
 
 db = SQLAlchemy()
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Use WAL journaling with relaxed fsync for SQLite connections"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
 class Message(db.Model):
     """Chat message with NLP analysis results"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_room_ts', 'room', 'timestamp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid4()))
     username = db.Column(db.String(50), nullable=False)
     room = db.Column(db.String(50), nullable=False, default='general')
     text = db.Column(db.Text, nullable=False)
@@ -21,23 +39,55 @@ class Message(db.Model):
     entities = db.Column(db.Text)  # JSON: list of {text, label, start, end}
     aspect_sentiment = db.Column(db.Text)  # JSON: {aspect: sentiment}
     
+    # Precomputed aggregates for analytics (see analytics.encode_analysis)
+    emotion_idx = db.Column(db.SmallInteger)  # index into Config.EMOTION_LABELS
+    sentiment_positive = db.Column(db.SmallInteger, default=0)
+    sentiment_negative = db.Column(db.SmallInteger, default=0)
+    sentiment_neutral = db.Column(db.SmallInteger, default=0)
+    
     def __repr__(self):
         return f'<Message {self.id}: {self.username} in {self.room}>'
     
     def to_dict(self):
         """Convert to dictionary for JSON serialization"""
         return {
-            'id': self.id,
+            'id': self.uuid,
             'username': self.username,
             'room': self.room,
             'text': self.text,
             'timestamp': self.timestamp.isoformat(),
             'emotion': self.emotion,
-            'emotion_scores': json.loads(self.emotion_scores) if self.emotion_scores else {},
-            'entities': json.loads(self.entities) if self.entities else [],
-            'aspect_sentiment': json.loads(self.aspect_sentiment) if self.aspect_sentiment else {}
+            'emotion_scores': loads(self.emotion_scores) if self.emotion_scores else {},
+            'entities': loads(self.entities) if self.entities else [],
+            'aspect_sentiment': loads(self.aspect_sentiment) if self.aspect_sentiment else {}
         }
 
+class EntityText(db.Model):
+    """Dictionary of distinct entity strings, so analytics can count integer ids"""
+    __tablename__ = 'entity_texts'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.String(200), unique=True, nullable=False)
+    
+    def __repr__(self):
+        return f'<EntityText {self.id}: {self.text}>'
+
+class Entity(db.Model):
+    """Named entity mention, denormalized from Message.entities for analytics"""
+    __tablename__ = 'entities'
+    __table_args__ = (
+        db.Index('ix_entities_room_text', 'room', 'text_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=False, index=True)
+    room = db.Column(db.String(50), nullable=False)
+    text_id = db.Column(db.Integer, db.ForeignKey('entity_texts.id'), nullable=False)
+    label = db.Column(db.String(20))
+    
+    def __repr__(self):
+        return f'<Entity {self.text_id} ({self.label}) in {self.room}>'
+
 class User(db.Model):
     """User information"""
     __tablename__ = 'users'
@@ -45,7 +95,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    last_active = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_active = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     message_count = db.Column(db.Integer, default=0)
     
     def __repr__(self):
@@ -0,0 +1,32 @@
+"""Fast JSON helpers for message analysis blobs"""
+from typing import Any
+
+try:
+    import orjson
+    
+    def dumps(obj: Any) -> str:
+        """Serialize to a JSON string using orjson"""
+        return orjson.dumps(obj).decode()
+    
+    loads = orjson.loads
+    
+except ImportError:
+    import json
+    
+    def dumps(obj: Any) -> str:
+        """Serialize to a JSON string (stdlib fallback)"""
+        return json.dumps(obj)
+    
+    loads = json.loads
+
+class SocketJSON:
+    """json-module compatible wrapper so SocketIO packets are encoded with dumps/loads above"""
+    
+    @staticmethod
+    def dumps(obj: Any, **kwargs) -> str:
+        # Formatting options such as separators are ignored; output is always compact
+        return dumps(obj)
+    
+    @staticmethod
+    def loads(data, **kwargs) -> Any:
+        return loads(data)
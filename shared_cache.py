@@ -0,0 +1,108 @@
+"""Redis-backed cache shared by all server workers"""
+import logging
+from typing import Dict, List, Optional
+
+from config import Config
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+class SharedCache:
+    """Recent message history and analytics snapshots per room, stored in Redis
+    
+    Every method is a no-op (or a cache miss) when no Redis URL is configured,
+    so callers fall back to the database.
+    """
+    
+    def __init__(self, url: Optional[str] = None):
+        self.client = None
+        if url:
+            import redis
+            self._watch_error = redis.WatchError
+            self.client = redis.Redis.from_url(url)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+    
+    @staticmethod
+    def _history_key(room: str) -> str:
+        return f'hist:{room}'
+    
+    @staticmethod
+    def _analytics_key(room: str) -> str:
+        return f'analytics:{room}'
+    
+    def push_message(self, room: str, message: Dict):
+        """Prepend a message to the room history, keeping the newest MESSAGE_HISTORY_SIZE
+        
+        LPUSHX leaves a missing key alone, so an unseeded room stays a cache
+        miss and the next join backfills it from the database.
+        """
+        if not self.enabled:
+            return
+        key = self._history_key(room)
+        try:
+            self.client.pipeline()\
+                .lpushx(key, dumps(message))\
+                .ltrim(key, 0, Config.MESSAGE_HISTORY_SIZE - 1)\
+                .execute()
+        except Exception as e:
+            logger.error(f'Error caching message for {room}: {e}')
+    
+    def set_history(self, room: str, messages: List[Dict]):
+        """Seed a missing room history with messages (oldest first)
+        
+        An existing list is never replaced: it may already hold messages that
+        the write-behind writer hasn't committed to the database yet.
+        """
+        if not self.enabled or not messages:
+            return
+        key = self._history_key(room)
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.watch(key)
+                if pipe.exists(key):
+                    return
+                pipe.multi()
+                pipe.lpush(key, *[dumps(message) for message in messages])
+                pipe.ltrim(key, 0, Config.MESSAGE_HISTORY_SIZE - 1)
+                pipe.execute()
+        except self._watch_error:
+            # Another worker seeded the room first; keep its list
+            pass
+        except Exception as e:
+            logger.error(f'Error caching history for {room}: {e}')
+    
+    def get_history(self, room: str) -> Optional[List[Dict]]:
+        """Recent messages for a room (oldest first), or None on a cache miss"""
+        if not self.enabled:
+            return None
+        try:
+            cached = self.client.lrange(self._history_key(room), 0, -1)
+        except Exception as e:
+            logger.error(f'Error reading history for {room}: {e}')
+            return None
+        if not cached:
+            return None
+        return [loads(message) for message in reversed(cached)]
+    
+    def get_analytics(self, room: str) -> Optional[Dict]:
+        """Cached analytics snapshot for a room, or None on a cache miss"""
+        if not self.enabled:
+            return None
+        try:
+            cached = self.client.get(self._analytics_key(room))
+        except Exception as e:
+            logger.error(f'Error reading analytics for {room}: {e}')
+            return None
+        return loads(cached) if cached else None
+    
+    def set_analytics(self, room: str, analytics: Dict):
+        """Cache an analytics snapshot for ANALYTICS_UPDATE_INTERVAL seconds"""
+        if not self.enabled:
+            return
+        try:
+            self.client.setex(self._analytics_key(room), Config.ANALYTICS_UPDATE_INTERVAL, dumps(analytics))
+        except Exception as e:
+            logger.error(f'Error caching analytics for {room}: {e}')